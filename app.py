@@ -1,58 +1,68 @@
 # app.py
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, render_template
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 from langchain.prompts import PromptTemplate
 from langchain_pinecone import PineconeVectorStore
-from langchain.schema.runnable import RunnablePassthrough
+from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.embeddings import Embeddings
+from pinecone import Pinecone
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import aclosing
+from functools import lru_cache, partial
+import hashlib
 import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import diskcache
+import google.generativeai as genai
+from google.generativeai import caching
 import logging
+import numpy as np
+import orjson
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
 
+# Faster event loop for async views and streaming, where available (not on Windows)
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 app = Flask(__name__)
 
+# (expires, isoformat, isoformat bytes, date bytes); responses only need second precision
+_clock = (0.0, "", b"", b"")
+
+def current_time():
+    """Return the cached timestamps, refreshed at most once per second"""
+    global _clock
+    now = time.monotonic()
+    if now >= _clock[0]:
+        current = datetime.now()
+        iso = current.isoformat(timespec='seconds')
+        _clock = (now + 1.0, iso, iso.encode(), current.strftime("%Y-%m-%d").encode())
+    return _clock
+
+def ojson(obj, status=200):
+    """Serialize obj with orjson straight to a JSON response"""
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class CISNRRAGSystem:
-    def __init__(self):
-        try:
-            # Load environment variables
-            self.google_api_key = os.getenv("GOOGLE_API_KEY")
-            self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
-            self.index_name = os.getenv("PINECONE_INDEX_NAME", "ncai")
-            
-            if not self.google_api_key:
-                raise ValueError("GOOGLE_API_KEY environment variable is not set")
-            if not self.pinecone_api_key:
-                raise ValueError("PINECONE_API_KEY environment variable is not set")
-            
-            # Initialize embeddings
-            self.embeddings = GoogleGenerativeAIEmbeddings(
-                model="models/embedding-001",
-                google_api_key=self.google_api_key
-            )
-            
-            # Initialize vector store
-            self.vectorstore = PineconeVectorStore.from_existing_index(
-                index_name=self.index_name,
-                embedding=self.embeddings
-            )
-            
-            # Initialize LLM
-            self.llm = ChatGoogleGenerativeAI(
-                model="gemini-1.5-flash",
-                temperature=0.3,
-                google_api_key=self.google_api_key,
-                max_tokens=1000
-            )
-            
-            # Create prompt template
-            self.prompt = PromptTemplate.from_template("""
+# Static instructions, kept separate so they can be stored in a Gemini context cache
+SYSTEM_INSTRUCTIONS = """
 You are an AI assistant representing CISNR (Centre of Intelligent System & Network Research) at UET Peshawar.
 Your role is to provide information about CISNR's work and mission based ONLY on the provided context.
 
@@ -67,24 +77,391 @@ IMPORTANT INSTRUCTIONS:
    - Suggest asking about CISNR's work instead
 6. Keep responses professional, informative, and concise (3-5 sentences)
 7. Use proper formatting with line breaks for readability
+"""
 
+# Per-request part of the prompt
+REQUEST_TEMPLATE = """
 Context about CISNR:
 {context}
 
 Question: {question}
 
 Answer in a clear, professional manner:
-""")
+"""
+
+FALLBACK_RESPONSE = """I apologize, but I'm currently experiencing technical difficulties. 
+Please try your question again later. For immediate assistance, 
+contact the CISNR directorate at cisnr@uetpeshawar.edu.pk."""
+
+OFF_TOPIC_RESPONSE = """I'm sorry, but I can't help with that question. 
+I specialize in topics related to CISNR (Centre of Intelligent System & Network Research) at UET Peshawar. 
+Feel free to ask about CISNR's research areas, projects, programs, team or facilities."""
+
+# Representative in-scope questions; their mean embedding marks the CISNR topic area
+TOPIC_EXAMPLES = [
+    "What is CISNR?",
+    "What does the Centre of Intelligent System & Network Research do?",
+    "What research areas does CISNR work on?",
+    "Which projects is CISNR currently working on?",
+    "Who is the director of CISNR?",
+    "Who are the researchers and faculty at CISNR?",
+    "What is CISNR's mission and vision?",
+    "Where is CISNR located at UET Peshawar?",
+    "How can I contact CISNR?",
+    "What academic programs does CISNR offer?",
+    "Does CISNR offer internships or research positions?",
+    "What publications has CISNR produced?",
+    "What laboratories and facilities does CISNR have?",
+    "Which industries and organizations does CISNR collaborate with?",
+    "What work does CISNR do in artificial intelligence and machine learning?",
+    "What work does CISNR do in computer networks and IoT?",
+    "What work does CISNR do in embedded and intelligent systems?",
+    "What services does CISNR provide to industry?",
+    "How can students join CISNR?",
+    "What trainings and workshops does CISNR organize?"
+]
+
+# Shared, bounded pool for blocking SDK calls made from async code. Every async Flask
+# request runs on its own event loop, whose default executor would otherwise be a new pool
+EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("CHAT_POOL", 64)),
+    thread_name_prefix="cisnr-blocking"
+)
+CHAT_TIMEOUT = float(os.getenv("CHAT_TIMEOUT", 30))
+
+# Roles a client may ask to be answered as; anything else is treated as the first one
+USER_ROLES = [role.strip() for role in os.getenv("USER_ROLES", "researcher").split(",") if role.strip()] or ["researcher"]
+
+def normalize_role(role):
+    role = str(role) if role is not None else ""
+    return role if role in USER_ROLES else USER_ROLES[0]
+
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, partial(func, *args))
+
+class ResponseCache:
+    """Two-tier answer cache: exact question text, then embedding similarity"""
+
+    LOOKUP_BLOCK_ROWS = 256
+
+    def __init__(self, max_size=1000, similarity_threshold=0.92):
+        self.max_size = max_size
+        self.similarity_threshold = similarity_threshold
+        self._exact = OrderedDict()
+        # Preallocated ring buffer of L2-normalized question embeddings, one row per entry,
+        # quantized to int8 with a per-row scale
+        self._keys = None
+        self._scales = np.zeros(max_size, dtype=np.float32)
+        self._n = 0
+        self._next = 0
+        self._entries = [None] * max_size
+        self._version = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(question):
+        return question.lower().strip()
+
+    @staticmethod
+    def _unit(vec):
+        vec = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    @staticmethod
+    def _quantize(vec):
+        scale = float(np.abs(vec).max()) / 127 or 1.0
+        return np.round(vec / scale).astype(np.int8), np.float32(scale)
+
+    def get_exact(self, question):
+        key = self.normalize(question)
+        with self._lock:
+            answer = self._exact.get(key)
+            if answer is not None:
+                self._exact.move_to_end(key)
+            return answer
+
+    def lookup(self, embedding, top_k=3, single_threshold=0.75, combined_threshold=1.4):
+        """Return (answer, related) for a question embedding.
+
+        ``answer`` is set on a near-duplicate hit. Otherwise ``related`` holds
+        the (question, answer) pairs that together cover the question well
+        enough to answer it without a fresh retrieval, or is empty.
+        """
+        vec = self._unit(embedding)
+        with self._lock:
+            version = self._version
+            result = None if self._n else (None, [])
+        
+        # Score without holding the lock; if a put() raced with us, rescore under it
+        if result is None:
+            result = self._score(vec, top_k, single_threshold, combined_threshold)
+            with self._lock:
+                if self._version != version:
+                    result = self._score(vec, top_k, single_threshold, combined_threshold)
+        return result
+
+    def _score(self, vec, top_k, single_threshold, combined_threshold):
+        n = self._n
+        keys = self._keys[:n]
+        scales = self._scales[:n]
+        entries = self._entries[:n]
+        
+        # Upcast in fixed-size row blocks so the dot products run through float32 BLAS
+        sims = np.empty(n, dtype=np.float32)
+        block = np.empty((min(n, self.LOOKUP_BLOCK_ROWS), keys.shape[1]), dtype=np.float32)
+        for start in range(0, n, self.LOOKUP_BLOCK_ROWS):
+            rows = keys[start:start + self.LOOKUP_BLOCK_ROWS]
+            np.copyto(block[:len(rows)], rows)
+            np.matmul(block[:len(rows)], vec, out=sims[start:start + len(rows)])
+        sims *= scales
+        
+        best = int(sims.argmax())
+        if sims[best] > self.similarity_threshold:
+            return entries[best][1], []
+        
+        if n > top_k:
+            top = np.argpartition(sims, -top_k)[-top_k:]
+        else:
+            top = np.arange(n)
+        top = [i for i in top[np.argsort(sims[top])[::-1]] if sims[i] > single_threshold]
+        if len(top) > 1 and sims[top].sum() > combined_threshold:
+            return None, [entries[i] for i in top]
+        return None, []
+
+    def put(self, question, embedding, answer):
+        key = self.normalize(question)
+        q_vec, q_scale = self._quantize(self._unit(embedding))
+        with self._lock:
+            self._exact[key] = answer
+            self._exact.move_to_end(key)
+            if len(self._exact) > self.max_size:
+                self._exact.popitem(last=False)
+
+            if self._keys is None:
+                self._keys = np.zeros((self.max_size, q_vec.shape[0]), dtype=np.int8)
+            # Overwrite the oldest row once full
+            row = self._next
+            self._keys[row] = q_vec
+            self._scales[row] = q_scale
+            self._entries[row] = (question, answer)
+            self._next = (row + 1) % self.max_size
+            self._n = min(self._n + 1, self.max_size)
+            self._version += 1
+
+class CachedEmbeddings(Embeddings):
+    """Google embeddings backed by an on-disk cache that survives restarts"""
+
+    def __init__(self, embeddings, cache_dir, memory_size=2048):
+        self.embeddings = embeddings
+        self.store = diskcache.Cache(cache_dir)
+        # Exceptions are not memoized, so misses raise KeyError instead of caching None
+        self._memo = lru_cache(maxsize=memory_size)(self._load)
+
+    def cache_key(self, kind, text):
+        # The model name is part of the key so switching models never serves stale vectors
+        model = getattr(self.embeddings, "model", "")
+        normalized = " ".join(text.split())
+        return f"{model}:{kind}:{hashlib.sha256(normalized.encode()).hexdigest()}"
+
+    def _load(self, key):
+        blob = self.store.get(key)
+        if blob is None:
+            raise KeyError(key)
+        return np.frombuffer(blob, dtype=np.float32).tolist()
+
+    def _get(self, key):
+        try:
+            return self._memo(key)
+        except KeyError:
+            return None
+
+    def get_cached(self, kind, text):
+        """Return the cached vector for text, or None without calling the API"""
+        return self._get(self.cache_key(kind, text))
+
+    def _embed_cached(self, kind, texts, embed_many):
+        keys = [self.cache_key(kind, text) for text in texts]
+        vectors = [self._get(key) for key in keys]
+        
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            fresh = embed_many([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                self.store.set(keys[i], np.asarray(vector, dtype=np.float32).tobytes())
+                vectors[i] = list(vector)
+        return vectors
+
+    def embed_documents(self, texts):
+        return self._embed_cached("doc", texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        return self._embed_cached(
+            "query",
+            texts,
+            lambda misses: self.embeddings.embed_documents(misses, task_type="retrieval_query")
+        )
+
+class EmbeddingBatcher:
+    """Coalesces concurrent query embeddings into a single batched API call"""
+
+    def __init__(self, embed_many, max_batch=32, window=0.01, timeout=30.0, lookup=None):
+        self._embed_many = embed_many
+        # Optional cache probe; hits are answered directly instead of waiting out the batch window
+        self._lookup = lookup
+        self.max_batch = max_batch
+        self.window = window
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        # A thread rather than an asyncio task: every async Flask request runs on its own event loop
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _cached(self, text):
+        return self._lookup(text) if self._lookup else None
+
+    def embed(self, text):
+        vector = self._cached(text)
+        if vector is not None:
+            return vector
+        return self.submit(text).result(timeout=self.timeout)
+
+    async def aembed(self, text):
+        vector = self._cached(text)
+        if vector is not None:
+            return vector
+        return await asyncio.wait_for(asyncio.wrap_future(self.submit(text)), self.timeout)
+
+    def _take(self, batch, item):
+        # Claim the future so a caller timing out can no longer cancel it; drop it if it already did
+        if item[1].set_running_or_notify_cancel():
+            batch.append(item)
+
+    @staticmethod
+    def _deliver(future, deliver, value):
+        try:
+            deliver(future, value)
+        except InvalidStateError:
+            pass
+
+    def _run(self):
+        while True:
+            batch = []
+            self._take(batch, self._queue.get())
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._take(batch, self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
             
-            # Create retriever
-            self.retriever = self.vectorstore.as_retriever(
-                search_kwargs={"k": 6, "include_metadata": True}
+            try:
+                vectors = self._embed_many([text for text, _ in batch])
+                if len(vectors) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+            except Exception as e:
+                logger.error(f"Error embedding batch of {len(batch)} questions: {str(e)}")
+                for _, future in batch:
+                    self._deliver(future, Future.set_exception, e)
+                continue
+            
+            for (_, future), vector in zip(batch, vectors):
+                self._deliver(future, Future.set_result, vector)
+
+class CISNRRAGSystem:
+    def __init__(self):
+        try:
+            # Load environment variables
+            self.google_api_key = os.getenv("GOOGLE_API_KEY")
+            self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
+            self.index_name = os.getenv("PINECONE_INDEX_NAME", "ncai")
+            self.cache_enabled = os.getenv("RESPONSE_CACHE", "True").lower() == "true"
+            # Keep a separate cache per role so role-specific answers are not cross-served
+            self.cache_per_role = os.getenv("RESPONSE_CACHE_PER_ROLE", "True").lower() == "true"
+            self.cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", 1000))
+            self.cache_threshold = float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.92))
+            # Retrieved context budget sent to Gemini
+            self.context_doc_chars = int(os.getenv("CONTEXT_DOC_CHARS", 700))
+            self.context_max_chars = int(os.getenv("CONTEXT_MAX_CHARS", 3000))
+            self.context_source_min_score = float(os.getenv("CONTEXT_SOURCE_MIN_SCORE", 0.5))
+            self._caches = {}
+            self._caches_lock = threading.Lock()
+            self.model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+            self.prompt_cache_enabled = os.getenv("GEMINI_CONTEXT_CACHE", "False").lower() == "true"
+            self.prompt_cache_ttl = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", 3600))
+            
+            if not self.google_api_key:
+                raise ValueError("GOOGLE_API_KEY environment variable is not set")
+            if not self.pinecone_api_key:
+                raise ValueError("PINECONE_API_KEY environment variable is not set")
+            
+            # Initialize embeddings, cached on disk across restarts
+            self.embeddings = CachedEmbeddings(
+                GoogleGenerativeAIEmbeddings(
+                    model="models/embedding-001",
+                    google_api_key=self.google_api_key
+                ),
+                cache_dir=os.getenv("EMBEDDING_CACHE_DIR", os.path.join(".cache", "embeddings")),
+                memory_size=int(os.getenv("EMBEDDING_MEMORY_CACHE_SIZE", 2048))
+            )
+            
+            # Batch query embeddings from concurrent requests
+            self.embedding_batcher = EmbeddingBatcher(
+                self.embed_queries,
+                max_batch=int(os.getenv("EMBED_BATCH_SIZE", 32)),
+                window=float(os.getenv("EMBED_BATCH_WINDOW_MS", 10)) / 1000,
+                timeout=float(os.getenv("EMBED_TIMEOUT", 30)),
+                lookup=partial(self.embeddings.get_cached, "query")
+            )
+            
+            # Initialize vector store on one shared, pooled Pinecone client
+            pool_threads = int(os.getenv("PINECONE_POOL_THREADS", 32))
+            self.pinecone = Pinecone(api_key=self.pinecone_api_key, pool_threads=pool_threads)
+            self.vectorstore = PineconeVectorStore(
+                index=self.pinecone.Index(self.index_name, pool_threads=pool_threads),
+                embedding=self.embeddings
             )
+            self.index_dimension = None
+            self.audit_index()
             
-            # Create chain
+            # Initialize LLM
+            self.llm = self.build_llm()
+            
+            # Create prompt template
+            self.prompt = PromptTemplate.from_template(SYSTEM_INSTRUCTIONS + REQUEST_TEMPLATE)
+            
+            # Gemini SDK model used directly on the hot path, without LangChain runnables
+            genai.configure(api_key=self.google_api_key)
+            self.generation_config = genai.GenerationConfig(temperature=0.3, max_output_tokens=1000)
+            self.genai_model = genai.GenerativeModel(self.model_name, generation_config=self.generation_config)
+            
+            # Plain format string + model used on the hot path, swapped as a pair
+            self.generator = (SYSTEM_INSTRUCTIONS + REQUEST_TEMPLATE, self.genai_model)
+            
+            # Optionally serve the static instructions from a Gemini context cache
+            self.prompt_cache = None
+            self._prompt_cache_expires = 0.0
+            self._prompt_cache_lock = threading.Lock()
+            if self.prompt_cache_enabled:
+                self.refresh_prompt_cache()
+            
+            # Create LCEL chain, kept for offline/eval use only, retrieving through the same single-embedding path
             self.chain = (
                 {
-                    "context": self.retriever | self.format_docs,
+                    "context": RunnableLambda(self.retrieve_context),
                     "question": RunnablePassthrough()
                 }
                 | self.prompt
@@ -92,6 +469,19 @@ Answer in a clear, professional manner:
                 | StrOutputParser()
             )
             
+            # Centroid of representative CISNR questions, used to refuse off-topic ones early
+            self.topic_threshold = float(os.getenv("TOPIC_MIN_SIMILARITY", 0.2))
+            self.topic_centroid = self.build_topic_centroid()
+            self.check_embedding_dimension()
+            self.topic_checks = 0
+            self.off_topic_count = 0
+            
+            # Open the Google and Pinecone connections before the first user arrives
+            self.warm_up()
+            self.keepalive_interval = int(os.getenv("KEEPALIVE_INTERVAL", 240))
+            if self.keepalive_interval > 0:
+                threading.Thread(target=self.keep_alive, name="connection-keepalive", daemon=True).start()
+            
             logger.info("CISNR RAG System initialized successfully")
             
         except Exception as e:
@@ -99,29 +489,326 @@ Answer in a clear, professional manner:
             raise
     
     def format_docs(self, docs):
-        formatted_docs = []
-        for i, doc in enumerate(docs):
+        parts = []
+        seen = set()
+        total = 0
+        for doc in docs:
             content = doc.page_content.strip()
-            metadata = doc.metadata
-            source_info = f"[Source: {metadata.get('source', 'unknown')} | Score: {metadata.get('score', 'N/A'):.3f}]" if metadata else ""
-            formatted_docs.append(f"Document {i+1}:\n{content}\n{source_info}")
-        return "\n\n".join(formatted_docs)
+            
+            # Over-chunked passages often come back several times with the same opening
+            fingerprint = " ".join(content[:400].lower().split())[:200]
+            if fingerprint in seen:
+                continue
+            seen.add(fingerprint)
+            
+            content = content[:self.context_doc_chars]
+            if total + len(content) > self.context_max_chars and parts:
+                break
+            total += len(content)
+            
+            part = f"Document {len(parts) + 1}:\n{content}"
+            score = doc.metadata.get('score')
+            if isinstance(score, (int, float)) and score >= self.context_source_min_score:
+                source = doc.metadata.get('source', 'unknown')
+                part += f"\n[Source: {source} | Score: {score:.3f}]"
+            parts.append(part)
+        return "\n\n".join(parts)
+    
+    def format_cached_answers(self, entries):
+        return "\n\n".join(
+            f"Document {i+1}:\nQ: {question}\nA: {answer}"
+            for i, (question, answer) in enumerate(entries)
+        )
+    
+    def get_cache(self, user_context=None):
+        if not self.cache_enabled:
+            return None
+        # Scopes are limited to USER_ROLES so clients cannot create unbounded caches
+        scope = normalize_role(user_context.get('role')) if (user_context and self.cache_per_role) else None
+        with self._caches_lock:
+            cache = self._caches.get(scope)
+            if cache is None:
+                cache = ResponseCache(self.cache_size, self.cache_threshold)
+                self._caches[scope] = cache
+            return cache
+    
+    def build_llm(self, **kwargs):
+        return ChatGoogleGenerativeAI(
+            model=self.model_name,
+            temperature=0.3,
+            google_api_key=self.google_api_key,
+            max_tokens=1000,
+            **kwargs
+        )
+    
+    def refresh_prompt_cache(self):
+        """Create or extend the Gemini context cache holding SYSTEM_INSTRUCTIONS"""
+        ttl = timedelta(seconds=self.prompt_cache_ttl)
+        try:
+            if self.prompt_cache is not None:
+                try:
+                    self.prompt_cache.update(ttl=ttl)
+                except Exception:
+                    # Already expired server-side, create a new one
+                    self.prompt_cache = None
+            
+            if self.prompt_cache is None:
+                self.prompt_cache = caching.CachedContent.create(
+                    model=f"models/{self.model_name}",
+                    display_name="cisnr-system-instructions",
+                    system_instruction=SYSTEM_INSTRUCTIONS,
+                    ttl=ttl
+                )
+                self.generator = (
+                    REQUEST_TEMPLATE,
+                    genai.GenerativeModel.from_cached_content(
+                        self.prompt_cache,
+                        generation_config=self.generation_config
+                    )
+                )
+            
+            # Refresh a minute early so requests never reference an expired cache
+            self._prompt_cache_expires = time.monotonic() + max(self.prompt_cache_ttl - 60, 0)
+            
+        except Exception as e:
+            logger.warning(f"Gemini context caching unavailable, sending full prompt: {str(e)}")
+            self.prompt_cache_enabled = False
+            self.prompt_cache = None
+            self.generator = (SYSTEM_INSTRUCTIONS + REQUEST_TEMPLATE, self.genai_model)
+    
+    def ensure_prompt_cache(self):
+        if not self.prompt_cache_enabled or time.monotonic() < self._prompt_cache_expires:
+            return
+        with self._prompt_cache_lock:
+            if self.prompt_cache_enabled and time.monotonic() >= self._prompt_cache_expires:
+                self.refresh_prompt_cache()
+    
+    def build_prompt(self, context, question):
+        self.ensure_prompt_cache()
+        template, model = self.generator
+        return model, template.format(context=context, question=question)
+    
+    def generate(self, context, question):
+        model, prompt = self.build_prompt(context, question)
+        return model.generate_content(prompt).text
+    
+    # The SDK's async client is bound to the first event loop that uses it, but every
+    # request here runs on a new loop, so generation goes through the sync client on EXECUTOR
+    async def agenerate(self, context, question):
+        return await run_blocking(self.generate, context, question)
+    
+    async def agenerate_stream(self, context, question):
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        finished = object()
+        stop = threading.Event()
+        
+        def send(item):
+            try:
+                loop.call_soon_threadsafe(chunks.put_nowait, item)
+            except RuntimeError:
+                # The request's loop is gone, nobody is reading anymore
+                stop.set()
+        
+        def produce():
+            try:
+                model, prompt = self.build_prompt(context, question)
+                for chunk in model.generate_content(prompt, stream=True):
+                    if stop.is_set():
+                        break
+                    # Chunks without parts (e.g. the final usage-only chunk) have no text
+                    if chunk.parts:
+                        send(chunk.text)
+            except Exception as e:
+                send(e)
+            finally:
+                send(finished)
+        
+        producer = loop.run_in_executor(EXECUTOR, produce)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            await producer
+        finally:
+            stop.set()
+    
+    def embed_queries(self, texts):
+        return self.embeddings.embed_queries(texts)
+    
+    def attach_scores(self, results):
+        # Pinecone returns the match score next to each document, not inside its metadata
+        docs = []
+        for doc, score in results:
+            doc.metadata["score"] = score
+            docs.append(doc)
+        return docs
+    
+    def retrieve(self, question_embedding):
+        results = self.vectorstore.similarity_search_by_vector_with_score(question_embedding, k=6)
+        return self.attach_scores(results)
+    
+    def retrieve_context(self, question):
+        return self.format_docs(self.retrieve(self.embedding_batcher.embed(question)))
+    
+    def audit_index(self):
+        """Log the Pinecone index configuration and flag brute-force pod types"""
+        try:
+            description = self.pinecone.describe_index(self.index_name)
+            self.index_dimension = description.dimension
+            pod_spec = getattr(description.spec, "pod", None)
+            index_type = f"pod ({pod_spec.pod_type})" if pod_spec else "serverless"
+            logger.info(
+                f"Pinecone index '{self.index_name}': {index_type}, "
+                f"metric={description.metric}, dimension={description.dimension}"
+            )
+            if pod_spec and pod_spec.pod_type.split(".")[0] in ("p1", "s1"):
+                logger.warning(
+                    f"Pinecone index '{self.index_name}' runs on {pod_spec.pod_type}; "
+                    "p2 or serverless gives lower query latency at this scale"
+                )
+        except Exception as e:
+            logger.warning(f"Could not describe Pinecone index '{self.index_name}': {str(e)}")
+    
+    def build_topic_centroid(self):
+        try:
+            vectors = np.asarray(self.embeddings.embed_queries(TOPIC_EXAMPLES), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            centroid = vectors.mean(axis=0)
+            return centroid / np.linalg.norm(centroid)
+        except Exception as e:
+            logger.warning(f"Could not build topic centroid, off-topic filter disabled: {str(e)}")
+            return None
+    
+    def is_off_topic(self, question_embedding):
+        if self.topic_centroid is None:
+            return False
+        vec = np.asarray(question_embedding, dtype=np.float32)
+        similarity = float(vec @ self.topic_centroid) / (float(np.linalg.norm(vec)) or 1.0)
+        
+        self.topic_checks += 1
+        if similarity >= self.topic_threshold:
+            return False
+        self.off_topic_count += 1
+        logger.info(
+            f"Refused off-topic question (similarity {similarity:.3f}); "
+            f"{self.off_topic_count}/{self.topic_checks} questions off-topic so far"
+        )
+        return True
+    
+    def check_embedding_dimension(self):
+        # A mismatched index fails every query, so refuse to start instead
+        if self.index_dimension is None or self.topic_centroid is None:
+            return
+        if self.topic_centroid.shape[0] != self.index_dimension:
+            raise ValueError(
+                f"Embedding dimension {self.topic_centroid.shape[0]} does not match "
+                f"Pinecone index '{self.index_name}' dimension {self.index_dimension}"
+            )
+    
+    def warm_up(self):
+        try:
+            # Bypass the embedding cache so the request actually reaches Google
+            vector = self.embeddings.embeddings.embed_query("warmup")
+            self.vectorstore.similarity_search_by_vector(vector, k=1)
+        except Exception as e:
+            logger.warning(f"Connection warm-up failed: {str(e)}")
+    
+    def keep_alive(self):
+        # Ping both endpoints so idle pooled connections are not reaped server-side
+        while True:
+            time.sleep(self.keepalive_interval)
+            self.warm_up()
+    
+    def enhance_question(self, question, user_context=None):
+        # Add user context to question if available
+        if user_context:
+            return f"[User: {user_context['role']}] {question}"
+        return question
     
     def query(self, question, user_context=None):
+        """Synchronous entry point for scripts; runs the async pipeline on its own loop"""
+        return asyncio.run(self.aquery(question, user_context))
+    
+    async def aretrieve(self, question_embedding):
+        # The sync search reuses the pooled Pinecone client instead of a per-loop async one
+        return await run_blocking(self.retrieve, question_embedding)
+    
+    async def aprepare(self, question, user_context=None):
+        """Return (cached_answer, context, question_embedding) for a question"""
+        cache = self.get_cache(user_context)
+        if cache is not None:
+            cached = cache.get_exact(question)
+            if cached is not None:
+                return cached, None, None
+        
+        question_embedding = await self.embedding_batcher.aembed(question)
+        if self.is_off_topic(question_embedding):
+            return OFF_TOPIC_RESPONSE, None, question_embedding
+        
+        # The in-memory lookup is far cheaper than a Pinecone query, so retrieve only on a miss
+        related = []
+        if cache is not None:
+            cached, related = cache.lookup(question_embedding)
+            if cached is not None:
+                return cached, None, question_embedding
+        
+        # Composite questions covered by earlier answers skip the vector search
+        if related:
+            context = self.format_cached_answers(related)
+        else:
+            context = self.format_docs(await self.aretrieve(question_embedding))
+        return None, context, question_embedding
+    
+    def remember(self, question, user_context, question_embedding, answer):
+        cache = self.get_cache(user_context)
+        if cache is not None and answer:
+            cache.put(question, question_embedding, answer)
+    
+    async def aquery(self, question, user_context=None):
         try:
-            # Add user context to question if available
-            enhanced_question = question
-            if user_context:
-                enhanced_question = f"[User: {user_context['role']}] {question}"
+            cached, context, question_embedding = await self.aprepare(question, user_context)
+            if cached is not None:
+                return cached
+            
+            enhanced_question = self.enhance_question(question, user_context)
+            result = await self.agenerate(context, enhanced_question)
             
-            result = self.chain.invoke(enhanced_question)
+            self.remember(question, user_context, question_embedding, result)
             return result
             
         except Exception as e:
             logger.error(f"Error processing query '{question}': {str(e)}")
-            return """I apologize, but I'm currently experiencing technical difficulties. 
-Please try your question again later. For immediate assistance, 
-contact the CISNR directorate at cisnr@uetpeshawar.edu.pk."""
+            return FALLBACK_RESPONSE
+    
+    async def astream_query(self, question, user_context=None):
+        """Yield the answer in text chunks as Gemini generates it"""
+        chunks = []
+        try:
+            cached, context, question_embedding = await self.aprepare(question, user_context)
+            if cached is not None:
+                yield cached
+                return
+            
+            enhanced_question = self.enhance_question(question, user_context)
+            # Close the inner stream here so an abandoned request does not leave it for the GC
+            async with aclosing(self.agenerate_stream(context, enhanced_question)) as stream:
+                async for text in stream:
+                    if text:
+                        chunks.append(text)
+                        yield text
+            
+            self.remember(question, user_context, question_embedding, "".join(chunks))
+            
+        except Exception as e:
+            logger.error(f"Error streaming query '{question}': {str(e)}")
+            if chunks:
+                raise
+            yield FALLBACK_RESPONSE
 
 # Initialize RAG system
 try:
@@ -135,113 +822,195 @@ def index():
     """Serve the main chat interface"""
     return render_template('index.html')
 
+def read_chat_request():
+    """Validate a chat request body; return (message, user_context, error_response)"""
+    data = request.get_json(silent=True)
+    
+    # Validate input
+    if not isinstance(data, dict) or not isinstance(data.get('message'), str):
+        return None, None, ojson({'error': 'Message is required'}, 400)
+    
+    message = data['message'].strip()
+    if not message:
+        return None, None, ojson({'error': 'Message cannot be empty'}, 400)
+    
+    # Extract user context if available
+    user_context = {
+        'role': normalize_role(data.get('role')),
+        'user_id': data.get('user_id', 'unknown'),
+        'session_id': data.get('session_id', 'unknown')
+    }
+    return message, user_context, None
+
 @app.route('/chat', methods=['POST'])
-def chat():
+async def chat():
     """Handle chat messages from the frontend"""
     if not rag_system:
-        return jsonify({
+        return ojson({
             'error': 'RAG system is not available',
             'response': 'I apologize, but the research assistant system is currently unavailable. Please try again later.'
-        }), 503
+        }, 503)
     
     try:
-        data = request.get_json()
-        
-        # Validate input
-        if not data or 'message' not in data:
-            return jsonify({'error': 'Message is required'}), 400
-        
-        message = data.get('message', '').strip()
-        if not message:
-            return jsonify({'error': 'Message cannot be empty'}), 400
-        
-        # Extract user context if available
-        user_context = {
-            'role': data.get('role', 'researcher'),
-            'user_id': data.get('user_id', 'unknown'),
-            'session_id': data.get('session_id', 'unknown')
-        }
+        message, user_context, error = read_chat_request()
+        if error:
+            return error
         
         logger.info(f"Received message from {user_context['user_id']}: {message}")
         
         # Get response from RAG system
-        response = rag_system.query(message, user_context)
+        try:
+            response = await asyncio.wait_for(rag_system.aquery(message, user_context), CHAT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Chat request from {user_context['user_id']} timed out after {CHAT_TIMEOUT}s")
+            return ojson({
+                'error': 'Request timed out',
+                'response': FALLBACK_RESPONSE
+            }, 504)
         
-        return jsonify({
+        return ojson({
             'question': message,
             'response': response,
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': current_time()[1],
             'source': 'cisnr-rag-system'
         })
         
     except Exception as e:
         logger.error(f"Error in chat endpoint: {str(e)}")
-        return jsonify({
+        return ojson({
             'error': 'Internal server error',
             'response': 'I apologize, but I encountered an error processing your request. Please try again.'
-        }), 500
+        }, 500)
+
+def iter_async(agen):
+    """Drive an async generator from a synchronous WSGI response iterator"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the answer to a chat message as server-sent events"""
+    if not rag_system:
+        return ojson({
+            'error': 'RAG system is not available',
+            'response': 'I apologize, but the research assistant system is currently unavailable. Please try again later.'
+        }, 503)
+    
+    try:
+        message, user_context, error = read_chat_request()
+        if error:
+            return error
+    except Exception as e:
+        logger.error(f"Error in chat stream endpoint: {str(e)}")
+        return ojson({
+            'error': 'Internal server error',
+            'response': 'I apologize, but I encountered an error processing your request. Please try again.'
+        }, 500)
+    
+    logger.info(f"Received streaming message from {user_context['user_id']}: {message}")
+    
+    async def events():
+        # Same overall deadline as /chat, applied to every step of the stream
+        stream = rag_system.astream_query(message, user_context)
+        deadline = asyncio.get_running_loop().time() + CHAT_TIMEOUT
+        try:
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                try:
+                    delta = await asyncio.wait_for(stream.__anext__(), max(remaining, 0))
+                except StopAsyncIteration:
+                    break
+                yield b"data: " + orjson.dumps({'delta': delta}) + b"\n\n"
+        except asyncio.TimeoutError:
+            logger.error(f"Chat stream from {user_context['user_id']} timed out after {CHAT_TIMEOUT}s")
+            yield b"data: " + orjson.dumps({'error': 'Request timed out'}) + b"\n\n"
+            return
+        except Exception as e:
+            # Part of the answer was already sent, so tell the client it is incomplete
+            logger.error(f"Error in chat stream endpoint: {str(e)}")
+            yield b"data: " + orjson.dumps({'error': 'The response was interrupted. Please try again.'}) + b"\n\n"
+            return
+        finally:
+            await stream.aclose()
+        yield b"data: " + orjson.dumps({'done': True, 'timestamp': current_time()[1]}) + b"\n\n"
+    
+    return Response(
+        iter_async(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Static response bodies, serialized once; only the date/time field is stamped per request
+RESOURCES = [
+    {
+        "title": "Research Publications",
+        "url": "/publications",
+        "icon": "file-pdf",
+        "category": "academic",
+        "description": "Access our latest research papers and publications"
+    },
+    {
+        "title": "Academic Programs",
+        "url": "/programs",
+        "icon": "graduation-cap",
+        "category": "education",
+        "description": "Learn about our academic offerings and collaborations"
+    },
+    {
+        "title": "Research Team",
+        "url": "/team",
+        "icon": "users",
+        "category": "people",
+        "description": "Meet our researchers and faculty members"
+    },
+    {
+        "title": "Facilities & Equipment",
+        "url": "/facilities",
+        "icon": "microscope",
+        "category": "infrastructure",
+        "description": "Explore our laboratories and research equipment"
+    }
+]
+
+_RESOURCES_JSON_TEMPLATE = orjson.dumps({
+    'resources': RESOURCES,
+    'count': len(RESOURCES)
+})[:-1] + b',"last_updated":"%s"}'
+
+_HEALTH_STATUS_CODE = 200 if rag_system else 503
+_HEALTH_JSON_TEMPLATE = orjson.dumps({
+    'status': 'healthy' if rag_system else 'degraded',
+    'service': 'CISNR Research Assistant',
+    'version': '1.0.0',
+    'dependencies': {
+        'rag_system': rag_system is not None,
+        'google_api': bool(os.getenv("GOOGLE_API_KEY")),
+        'pinecone': bool(os.getenv("PINECONE_API_KEY"))
+    }
+})[:-1] + b',"timestamp":"%s"}'
 
 @app.route('/api/health')
 def health():
     """Health check endpoint"""
-    status = 'healthy' if rag_system else 'degraded'
-    code = 200 if rag_system else 503
-    
-    return jsonify({
-        'status': status,
-        'service': 'CISNR Research Assistant',
-        'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0',
-        'dependencies': {
-            'rag_system': rag_system is not None,
-            'google_api': bool(os.getenv("GOOGLE_API_KEY")),
-            'pinecone': bool(os.getenv("PINECONE_API_KEY"))
-        }
-    }), code
+    body = _HEALTH_JSON_TEMPLATE % current_time()[2]
+    return Response(body, status=_HEALTH_STATUS_CODE, mimetype='application/json')
 
 @app.route('/api/resources')
 def resources():
     """API endpoint for research resources"""
-    resources = [
-        {
-            "title": "Research Publications",
-            "url": "/publications",
-            "icon": "file-pdf",
-            "category": "academic",
-            "description": "Access our latest research papers and publications"
-        },
-        {
-            "title": "Academic Programs",
-            "url": "/programs",
-            "icon": "graduation-cap",
-            "category": "education",
-            "description": "Learn about our academic offerings and collaborations"
-        },
-        {
-            "title": "Research Team",
-            "url": "/team",
-            "icon": "users",
-            "category": "people",
-            "description": "Meet our researchers and faculty members"
-        },
-        {
-            "title": "Facilities & Equipment",
-            "url": "/facilities",
-            "icon": "microscope",
-            "category": "infrastructure",
-            "description": "Explore our laboratories and research equipment"
-        }
-    ]
-    
-    return jsonify({
-        'resources': resources,
-        'count': len(resources),
-        'last_updated': datetime.now().strftime("%Y-%m-%d")
-    })
+    body = _RESOURCES_JSON_TEMPLATE % current_time()[3]
+    return Response(body, mimetype='application/json')
 
 if __name__ == '__main__':
-    from datetime import datetime
-    
     # Set environment variables for Pinecone if not already set
     if not os.getenv("PINECONE_API_KEY"):
         os.environ["PINECONE_API_KEY"] = "your-pinecone-api-key-here"
@@ -0,0 +1,25 @@
+# gunicorn_conf.py
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Flask is WSGI: async views run on a per-request event loop inside a worker thread,
+# so threaded workers are what let one process overlap many in-flight LLM/vector calls
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+
+# Only used by the gevent/eventlet worker classes
+worker_connections = 1000
+
+keepalive = 30
+# Generation can take a while and /chat/stream keeps the connection open
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+
+# Do not preload: the RAG system starts background threads that would not survive the fork
+preload_app = False
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")